@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Groups the pages of a Message Report into messages, given the marker found on each page.
+
+This is the per-page loop of the split. It has no dependencies beyond the standard
+library so that it can be compiled to a C extension with Cython for speed:
+
+    pip install cython
+    python setup.py build_ext --inplace
+
+When the extension is not built, Python imports this file as a regular module.
+Once it is built, Python imports the compiled _ofw_scan*.so (or .pyd) instead and
+ignores this file, so after editing it, rebuild the extension or delete it.
+"""
+
+
+def find_message_boundaries(page_markers):
+    """
+    Computes the page range of each message from the per-page markers.
+
+    A page with a marker for a different message than the current one starts a
+    new message. Pages without a marker, or repeating the current marker, continue
+    the current message. Pages before the first marker are skipped.
+
+    Args:
+        page_markers (list): One entry per page: a (message number, total messages)
+                             tuple if the page has a "Message X of Y" marker,
+                             otherwise None.
+
+    Returns:
+        list: (start_page, end_page, message_number, total_messages) tuples with
+              zero-based, inclusive page indexes, in document order.
+    """
+    # --- State variables for tracking messages during page iteration ---
+    current_message_number = 0 # Tracks the message number being currently processed.
+    total_messages_reported = 0 # Stores the total number of messages reported in the markers.
+    message_start_page = -1 # Index of the first page of the current message (-1 before the first marker).
+    message_end_page = -1 # Index of the last page seen so far for the current message.
+    last_marker = None # Store the last (message number, total messages) marker found
+    # Page ranges found by the scan, as (start_page, end_page, message_number, total_messages).
+    boundaries = []
+
+    for page_num in range(len(page_markers)):
+        marker = page_markers[page_num]
+
+        if marker is not None:
+            # A message marker was found on this page.
+            found_message_num, found_total_messages = marker
+            last_marker = marker # Store the latest marker
+
+            # Initialize or verify the total message count.
+            if total_messages_reported == 0:
+                total_messages_reported = found_total_messages
+            elif total_messages_reported != found_total_messages:
+                # Log a warning if the total count changes mid-document.
+                print(f"Warning: Total message count changed from {total_messages_reported} to {found_total_messages} on page {page_num + 1}")
+                total_messages_reported = found_total_messages # Update to the latest reported count
+
+            # Check if this marker indicates the start of a *new* message.
+            if found_message_num != current_message_number:
+                # If a previous message is open, record its page range.
+                if message_start_page >= 0:
+                    boundaries.append((message_start_page, message_end_page,
+                                       current_message_number, total_messages_reported))
+
+                # Start a new page range for the newly found message.
+                current_message_number = found_message_num
+                message_start_page = message_end_page = page_num
+                continue
+
+        # No marker, or the same marker as the current message: the page continues it.
+        if current_message_number > 0:
+            # If we are already tracking a message, extend its range to this page.
+            message_end_page = page_num
+        else:
+            # This page appears before the very first message marker. Skip it.
+            print(f"Skipping page {page_num + 1} (appears before first message marker)")
+
+    # --- After the loop: Record the page range of the very last message ---
+    if message_start_page >= 0 and current_message_number > 0:
+        # Ensure total_messages_reported is sensible even if the last page didn't have a clear marker
+        # (e.g., if the very last message only had one page which had the marker).
+        if total_messages_reported == 0 and last_marker:
+            total_messages_reported = last_marker[1]
+        elif total_messages_reported == 0:
+            print("Warning: Could not determine total message count for the last message.")
+            total_messages_reported = 'X' # Use a placeholder if count is unknown
+        boundaries.append((message_start_page, message_end_page,
+                           current_message_number, total_messages_reported))
+
+    return boundaries
@@ -4,8 +4,9 @@ Flask web application to split a "Message Report" output from OurFamilyWizard in
 
 Assumes the Message Report is in a PDF form and is text readable. This application processes the PDF,
 splits it into individual PDF files (one per message), zips these files,
-and provides the zip archive for download. It uses temporary directories for
-intermediate file storage and cleans them up after processing.
+and provides the zip archive for download. Each upload becomes a job with its
+own directory; jobs are processed by RQ workers when Redis is configured, and
+expired job directories are cleaned up automatically.
 """
 
 import os
@@ -14,17 +15,60 @@ import zipfile
 import tempfile
 import shutil
 import io
+import subprocess
+import time
+import mmap
+import hashlib
+import socket
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+    import msvcrt
 from flask import (
-    Flask, request, render_template, send_file, flash, redirect, url_for
+    Flask, Response, request, render_template, send_file, jsonify, abort, url_for
 )
 from werkzeug.utils import secure_filename
-from pypdf import PdfReader, PdfWriter
+from redis import Redis
+from rq import Queue
+import pymupdf
+from _ofw_scan import find_message_boundaries
 
 # --- Configuration ---
 
 # Allowed file extensions for upload. Prevents upload of non-PDF files.
 ALLOWED_EXTENSIONS = {'pdf'}
 
+# Buffer size used when copying the uploaded file to disk in userspace.
+UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Regex to find the message marker (e.g., "Message 1 of 10").
+# Captures the current message number (group 1) and total messages (group 2).
+# Compiled once at import time rather than on every request.
+MESSAGE_RE = re.compile(r"Message\s+(\d+)\s+of\s+(\d+)")
+
+# The marker is part of the page header, so only the start of each page's text
+# is searched. This avoids running the regex over the full message body.
+MARKER_SEARCH_CHARS = 512
+
+# Maximum time pdftotext may take on one upload before per-page extraction is
+# used instead, so a malformed file cannot hang the request or worker.
+PDFTOTEXT_TIMEOUT_SECONDS = 120
+
+# Byte-level version of MESSAGE_RE, run over a page's raw content stream as a
+# cheap prefilter before full text extraction. Text drawn via hex strings,
+# CMap-encoded fonts or kerned strings will not match. A miss is only trusted
+# once a raw hit has been confirmed on a real marker page of the same document,
+# and the pages are extracted in full if the markers found are then incomplete.
+RAW_MESSAGE_RE = re.compile(rb"Message\s+(\d+)\s+of\s+(\d+)")
+
+# Header of an indirect object ("12 0 obj"), matched just before the "obj" keyword
+# to find which object a raw marker match lies in.
+OBJECT_HEADER_RE = re.compile(rb"(\d+)\s+\d+\s+obj\Z")
+
+# Indirect reference ("12 0 R"), as found in a page's /Contents entry.
+OBJECT_REF_RE = re.compile(r"(\d+)\s+\d+\s+R")
+
 # Initialize the Flask application instance.
 app = Flask(__name__)
 
@@ -33,9 +77,60 @@ app = Flask(__name__)
 # secure configuration file in production.
 app.config['SECRET_KEY'] = 'your_very_secret_and_random_key_123!' # Change this!
 
-# Optional: Configure max upload size to prevent Denial-of-Service via large uploads.
-# Example: 50MB limit. Uncomment and adjust as needed for your environment.
-# app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+# Max upload size, to prevent Denial-of-Service via large uploads. Larger requests
+# are rejected with 413 by Werkzeug before the body is read. Adjust as needed.
+app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
+
+# Reports with more pages than this are rejected before any splitting work starts.
+MAX_PAGES = 2000
+
+# Directory holding one subdirectory per job: the uploaded PDF while it is being
+# split, then the finished ZIP archive. When a task queue is used, this must be
+# a location shared by the web server and the queue workers.
+app.config['JOB_DIR'] = os.environ.get('OFW_JOB_DIR', os.path.join(tempfile.gettempdir(), 'ofw_jobs'))
+
+# Let the front-end web server send finished archives instead of a Python worker.
+# For nginx, set OFW_X_ACCEL_PREFIX to an `internal` location aliased to JOB_DIR
+# (e.g. "/protected/"); downloads are then answered with an X-Accel-Redirect
+# header. For Apache/lighttpd, OFW_USE_X_SENDFILE=1 enables Flask's X-Sendfile support.
+app.config['X_ACCEL_REDIRECT_PREFIX'] = os.environ.get('OFW_X_ACCEL_PREFIX')
+app.config['USE_X_SENDFILE'] = os.environ.get('OFW_USE_X_SENDFILE') == '1'
+
+# Job directories older than this are removed, whether or not they were downloaded.
+# This also cleans up archives sent by the front-end server, as their download
+# completes after the Python response has returned.
+JOB_TTL_SECONDS = 60 * 60
+
+# Maximum time a queue worker may spend on a single job. Inline jobs that have
+# not finished after this long are treated as failed.
+JOB_TIMEOUT_SECONDS = 30 * 60
+
+# Job IDs are the hex BLAKE2b digest (16 bytes) of the uploaded file, keyed with a
+# server-side secret, so uploading the same report again reuses the finished archive
+# while others holding a copy cannot compute its job ID. Anything else in a URL is rejected.
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+# How long an upload waits for another upload of the same file to finish claiming
+# its job directory.
+JOB_CLAIM_WAIT_SECONDS = 10
+
+# Maximum time a Redis command may block, so a stalled Redis server cannot hold an
+# upload (and the job's claim lock) until the WSGI server kills the worker.
+REDIS_SOCKET_TIMEOUT_SECONDS = 10
+
+# At most this many finished archives are kept; beyond it, the least recently
+# used ones are removed first.
+MAX_CACHED_JOBS = 100
+
+# Background task queue. When REDIS_URL is set, uploads are split by RQ workers
+# (`rq worker --url $REDIS_URL`) and the client polls for the result. Without it,
+# jobs run inline during the upload request, which is convenient for development.
+REDIS_URL = os.environ.get('REDIS_URL')
+task_queue = Queue(connection=Redis.from_url(
+    REDIS_URL,
+    socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+)) if REDIS_URL else None
 
 # --- Helper Functions ---
 
@@ -52,164 +147,860 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def _remove_dir(path):
+    """
+    Removes a directory and its contents.
+
+    Errors are logged but not raised, so cleanup never interrupts the user flow.
+
+    Args:
+        path (str or None): The directory to remove. Does nothing if None
+                            or if the directory no longer exists.
+    """
+    if path and os.path.exists(path):
+        print(f"Cleaning up directory: {path}")
+        try:
+            shutil.rmtree(path) # Recursively delete the directory.
+            print("Directory cleaned up successfully.")
+        except Exception as cleanup_error:
+            # Log errors during cleanup, but don't interrupt the user flow.
+            print(f"Error cleaning up directory {path}: {cleanup_error}")
+            # Consider using app.logger for production logging.
+
+def _open_private(path, flags):
+    """
+    Opener for open() that creates files readable by their owner only.
+
+    Uploads are private messages, so they are never made readable by other users.
+    """
+    return os.open(path, flags, 0o600)
+
+def _front_end_sends_archives():
+    """
+    Checks whether finished archives are sent by the front-end web server.
+
+    Returns:
+        bool: True if X-Accel-Redirect or X-Sendfile is configured. The front-end
+              server then needs group access to the job directories and archives.
+    """
+    return bool(app.config['X_ACCEL_REDIRECT_PREFIX']) or app.config['USE_X_SENDFILE']
+
+def _save_upload(file, upload_path):
+    """
+    Saves an uploaded file to disk.
+
+    Werkzeug spools uploads to a SpooledTemporaryFile, which only moves to a real
+    temporary file once the upload outgrows its memory buffer. In that case the
+    data is copied kernel-side with os.copy_file_range (Linux), avoiding a round
+    trip through userspace. Otherwise, or if the kernel refuses the copy, the
+    stream is copied with a large buffer.
+
+    Args:
+        file (werkzeug.datastructures.FileStorage): The uploaded file.
+        upload_path (str): Path of the file to create.
+    """
+    stream = file.stream
+    start = stream.tell()
+    with open(upload_path, 'wb', buffering=0, opener=_open_private) as dst:
+        # Calling fileno() on a SpooledTemporaryFile still held in memory would first
+        # write it out to a temporary file, so such uploads are copied from memory.
+        if hasattr(os, 'copy_file_range') and getattr(stream, '_rolled', True):
+            try:
+                src_fd = stream.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                src_fd = None # In-memory stream; there is no file descriptor to copy from.
+            if src_fd is not None:
+                try:
+                    offset = start
+                    while True:
+                        # Copy up to 64 MB per call until the end of the source is reached.
+                        copied = os.copy_file_range(src_fd, dst.fileno(), 64 * 1024 * 1024,
+                                                    offset_src=offset)
+                        if copied == 0:
+                            return
+                        offset += copied
+                except OSError as e:
+                    # e.g. unsupported by the filesystem; discard any partial copy and fall back.
+                    print(f"Warning: copy_file_range failed ({e}). Falling back to a buffered copy.")
+                    dst.seek(0)
+                    dst.truncate()
+        stream.seek(start)
+        shutil.copyfileobj(stream, dst, length=UPLOAD_COPY_BUFFER_SIZE)
+
+def _prepare_job_root(path):
+    """
+    Creates the directory holding the job directories, and checks that other
+    users cannot tamper with it.
+
+    The default location is a fixed path in the shared temporary directory, so
+    another local user could create it first and then read or replace the jobs
+    in it. An existing directory is therefore only used if it belongs to the
+    current user and is not writable by its group or by others.
+
+    Args:
+        path (str): The JOB_DIR directory.
+
+    Raises:
+        RuntimeError: If the directory is owned by another user or is group or
+                      world writable.
+    """
+    os.makedirs(path, mode=0o750 if _front_end_sends_archives() else 0o700, exist_ok=True)
+    st = os.stat(path)
+    # Neither check applies on Windows: os.getuid is not available, and os.stat
+    # reports every directory as mode 0o777.
+    if os.name == 'nt':
+        return
+    if st.st_uid != os.getuid():
+        raise RuntimeError(f"Job directory {path} is owned by another user; set OFW_JOB_DIR to a private directory.")
+    if st.st_mode & 0o022:
+        raise RuntimeError(f"Job directory {path} is writable by other users; set OFW_JOB_DIR to a private directory.")
+
+def _load_job_id_key(jobs_root):
+    """
+    Returns the secret key used to compute job IDs.
+
+    The key is generated on first use and stored in JOB_DIR, so every web server
+    and queue worker sharing the directory computes the same job IDs. It is
+    written to a temporary file and hard-linked into place, so processes starting
+    at the same time never read a partially written key.
+
+    Args:
+        jobs_root (str): The JOB_DIR directory.
+
+    Returns:
+        bytes: The key.
+    """
+    key_path = os.path.join(jobs_root, 'job_id.key')
+    if not os.path.exists(key_path):
+        fd, tmp_path = tempfile.mkstemp(dir=jobs_root) # Readable by its owner only.
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(os.urandom(32))
+            try:
+                os.link(tmp_path, key_path)
+            except FileExistsError:
+                pass # Created by another process in the meantime; use theirs.
+        finally:
+            os.remove(tmp_path)
+    with open(key_path, 'rb') as f:
+        return f.read()
+
+# Checked on import, so the web server and the queue workers refuse to start with
+# a job directory that other users could tamper with.
+_prepare_job_root(app.config['JOB_DIR'])
+JOB_ID_KEY = _load_job_id_key(app.config['JOB_DIR'])
+
 # --- PDF Splitting Function ---
 
-def split_messages_pdf(input_pdf_path, output_dir):
+def _enclosing_object_number(data, offset):
+    """
+    Finds the number of the indirect object that contains a byte offset.
+
+    Args:
+        data (mmap.mmap or bytes): The raw PDF file contents.
+        offset (int): Byte offset inside the file.
+
+    Returns:
+        int or None: The object number, or None if no object header precedes the offset.
+    """
+    pos = offset
+    while True:
+        pos = data.rfind(b"obj", 0, pos)
+        if pos < 0:
+            return None
+        # Skips "endobj" and stray "obj" bytes, which are not preceded by "N G ".
+        header = OBJECT_HEADER_RE.search(data, max(0, pos - 24), pos + 3)
+        if header:
+            return int(header.group(1))
+
+def _scan_raw_markers(input_pdf_path, src):
+    """
+    Locates the message markers by searching the raw bytes of the PDF file.
+
+    This limits text extraction to the pages that contain a match, but only
+    works when the page content streams are stored uncompressed with the marker
+    as a literal string. Each match is mapped to a page through the object it
+    lies in and the pages' /Contents references. The candidate pages are then
+    confirmed by searching the header area of their text, exactly like the text
+    scan. The result is only used if it accounts for every message from 1 to the
+    reported total; otherwise callers must fall back to text extraction.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        src (pymupdf.Document): The same file opened with PyMuPDF.
+
+    Returns:
+        dict or None: Maps page index to (message number, total messages) for
+                      each page with a marker, or None if the raw scan could not
+                      locate all markers.
+    """
+    with open(input_pdf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # Copy out the offsets, as match objects would keep the mmap from closing.
+        offsets = [m.start() for m in RAW_MESSAGE_RE.finditer(mm)]
+        if not offsets:
+            return None # Typical for compressed content streams.
+
+        # Map each content stream's object number to the page it belongs to.
+        content_pages = {}
+        for page_num in range(src.page_count):
+            _, contents = src.xref_get_key(src.page_xref(page_num), "Contents")
+            for xref in OBJECT_REF_RE.findall(contents):
+                content_pages[int(xref)] = page_num
+
+        # Pages whose content contains a match. Matches outside page content
+        # (e.g. bookmarks or metadata) are ignored.
+        candidate_pages = set()
+        for offset in offsets:
+            page_num = content_pages.get(_enclosing_object_number(mm, offset))
+            if page_num is not None:
+                candidate_pages.add(page_num)
+
+    # A raw match may be a message body quoting another message ("as I said in
+    # Message 2 of 2"). Confirm each candidate with the same header rule as the
+    # text scan, so the split does not depend on whether the streams are compressed.
+    markers = {}
+    for page_num in sorted(candidate_pages):
+        match = MESSAGE_RE.search(src.load_page(page_num).get_text("text", flags=0), 0, MARKER_SEARCH_CHARS)
+        if match:
+            markers[page_num] = (int(match.group(1)), int(match.group(2)))
+
+    if not _markers_complete(markers.values()):
+        return None
+    return markers
+
+def _extract_page_texts(input_pdf_path, num_pages):
+    """
+    Extracts the text of every page in one pass using poppler's `pdftotext`.
+
+    Running the native binary once is much faster than extracting each page
+    from Python. `pdftotext` terminates every page with a form feed, so the
+    output is split on that character to recover per-page text.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        num_pages (int): Number of pages in the PDF, used to validate the output.
+
+    Returns:
+        list or None: A list with the text of each page, or None if `pdftotext`
+                      is not installed or its output could not be used. Callers
+                      should fall back to per-page extraction in that case.
+    """
+    if shutil.which("pdftotext") is None:
+        return None
+    try:
+        # -raw keeps text in content stream order, skipping layout analysis,
+        # which is all that is needed to find the "Message X of Y" markers.
+        proc = subprocess.run(
+            ["pdftotext", "-raw", input_pdf_path, "-"],
+            capture_output=True, check=True, timeout=PDFTOTEXT_TIMEOUT_SECONDS
+        )
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        print(f"Warning: pdftotext failed ({e}). Falling back to per-page text extraction.")
+        return None
+
+    # The output ends with a form feed, leaving one trailing empty element.
+    pages_text = proc.stdout.decode("utf-8", "replace").split("\x0c")[:num_pages]
+    if len(pages_text) != num_pages:
+        print("Warning: pdftotext page count mismatch. Falling back to per-page text extraction.")
+        return None
+    return pages_text
+
+
+def _markers_complete(page_markers):
+    """
+    Checks that a scan found a marker for every message of the report.
+
+    Args:
+        page_markers (iterable): (message number, total messages) tuples, or
+                                 None for pages without a marker.
+
+    Returns:
+        bool: True if all markers report the same total and every message
+              number from 1 to that total was found.
+    """
+    markers = [marker for marker in page_markers if marker is not None]
+    totals = {total for _, total in markers}
+    if len(totals) != 1:
+        return False
+    # The total is read from the PDF, so it is compared with what was found rather
+    # than used to build the expected set of numbers.
+    total = totals.pop()
+    numbers = {number for number, _ in markers}
+    return len(numbers) == total and min(numbers) == 1 and max(numbers) == total
+
+def _find_page_markers(src, page_texts, use_raw_prefilter, header_only=True):
+    """
+    Finds the "Message X of Y" marker in the header area of each page's text.
+
+    Args:
+        src (pymupdf.Document): The open source document.
+        page_texts (list or None): Text of every page from pdftotext, or None to
+                                   extract each page's text with PyMuPDF.
+        use_raw_prefilter (bool): When extracting with PyMuPDF, skip text extraction
+                                  on pages whose raw content stream does not contain
+                                  a marker, once a raw hit has been confirmed on the
+                                  first marker page. Callers must verify the result
+                                  with _markers_complete, since a marker that is not
+                                  stored literally (e.g. kerned) is missed this way.
+        header_only (bool): Search only the first MARKER_SEARCH_CHARS characters of
+                            each page's text. The text is in content stream order,
+                            so a header drawn after the body is only found with False.
+
+    Returns:
+        tuple: A tuple containing:
+            - list: One entry per page: (message number, total messages), or
+                    None if the page has no marker.
+            - int: The number of pages skipped by the raw prefilter.
+    """
+    # Bind frequently used methods locally to avoid the attribute lookups on every page.
+    search = MESSAGE_RE.search
+    raw_search = RAW_MESSAGE_RE.search
+    load_page = src.load_page
+    search_chars = MARKER_SEARCH_CHARS if header_only else None
+
+    # Whether a raw content stream miss can be taken to mean "no marker on this page".
+    # None until the first marker page is seen; set to whether that page's raw
+    # content matched RAW_MESSAGE_RE. Only used for per-page extraction.
+    raw_prefilter_trusted = None if use_raw_prefilter else False
+    raw_hit = False
+    skipped_pages = 0
+
+    page_markers = []
+    for page_num in range(src.page_count):
+        marker = None
+        try:
+            # Use the pdftotext output if available, otherwise extract the text of this page.
+            if page_texts is not None:
+                text = page_texts[page_num]
+            else:
+                page_obj = load_page(page_num)
+                if use_raw_prefilter:
+                    raw_hit = raw_search(page_obj.read_contents()) is not None
+                if raw_prefilter_trusted and not raw_hit:
+                    # The raw content stream has no marker, so skip the costly
+                    # text extraction and treat this as a continuation page.
+                    skipped_pages += 1
+                    page_markers.append(None)
+                    continue
+                # flags=0 turns off ligature/whitespace preservation and media box
+                # clipping, none of which matter for finding the marker.
+                text = page_obj.get_text("text", flags=0)
+
+            if not text:
+                # Handle pages where text extraction fails (e.g., image-only pages).
+                # Such pages are assumed to belong to the currently active message.
+                print(f"Warning: Could not extract text from page {page_num + 1}. Assuming it belongs to the current message.")
+            else:
+                # Search for the message marker pattern in the header area of the extracted text.
+                match = search(text, 0, search_chars or len(text))
+                if match:
+                    marker = (int(match.group(1)), int(match.group(2)))
+                    # Decide once, on the first marker page, whether the raw prefilter can be relied on.
+                    if page_texts is None and raw_prefilter_trusted is None:
+                        raw_prefilter_trusted = raw_hit
+
+        except Exception as page_ex:
+            # Handle errors during processing of a single page; it is treated as
+            # having no marker, and processing continues with the rest of the PDF.
+            print(f"Error processing page {page_num + 1}: {page_ex}")
+
+        page_markers.append(marker)
+
+    return page_markers, skipped_pages
+
+
+def _copy_page_range(src, first_page, last_page):
+    """
+    Copies a contiguous range of pages from an open document into a new PDF.
+
+    PyMuPDF copies the whole range in a single call, so no per-page Python
+    objects are created for the output.
+
+    Args:
+        src (pymupdf.Document): The open source document.
+        first_page (int): Zero-based index of the first page to copy.
+        last_page (int): Zero-based index of the last page to copy (inclusive).
+
+    Returns:
+        bytes: The contents of the new PDF file.
+    """
+    dst = pymupdf.open()
+    try:
+        # Links and annotations are not copied: the report's pages carry the content
+        # as page text, and copying them adds per-page work for every message.
+        dst.insert_pdf(src, from_page=first_page, to_page=last_page, links=False, annots=False)
+        # deflate compresses uncompressed streams; garbage=3 drops unused and
+        # duplicate objects carried over from the source document.
+        return dst.tobytes(deflate=True, garbage=3)
+    finally:
+        dst.close()
+
+
+def _build_message(src, boundary):
+    """
+    Builds the PDF for one message from its page range.
+
+    Args:
+        src (pymupdf.Document): The open source document.
+        boundary (tuple): (start_page, end_page, message_number, total_messages)
+                          as recorded by the scan in split_messages_pdf.
+
+    Returns:
+        tuple: The message's file name and the contents of its PDF file (bytes).
+    """
+    start_page, end_page, message_number, total_messages = boundary
+    output_filename = f"message_{message_number}_of_{total_messages}.pdf"
+    pdf_bytes = _copy_page_range(src, start_page, end_page)
+    print(f"   Built: {output_filename} ({end_page - start_page + 1} pages)")
+    return output_filename, pdf_bytes
+
+
+def _generate_messages(input_pdf_path, boundaries):
+    """
+    Builds the PDF of each message, yielding them one at a time in order.
+
+    Only one finished PDF is held in memory at a time, so the caller can write
+    each one out before the next is built. The messages are built serially:
+    copying a message takes about a millisecond, far less than starting worker
+    processes for it, and concurrent uploads already run in separate processes.
+
+    Args:
+        input_pdf_path (str): Path to the input PDF file.
+        boundaries (list): Page ranges found by the scan, as
+                           (start_page, end_page, message_number, total_messages).
+
+    Yields:
+        tuple: The message's file name and the contents of its PDF file (bytes).
+    """
+    with pymupdf.open(input_pdf_path) as src:
+        for boundary in boundaries:
+            yield _build_message(src, boundary)
+
+
+def split_messages_pdf(input_pdf_path):
     """
     Splits a PDF containing multiple messages into individual PDFs per message.
 
     It searches each page's text for a pattern "Message X of Y" to identify
     the start of a new message and determine the total count. Pages between
     markers (or after the last marker) are grouped into separate output PDFs.
+    The whole document is scanned first to find each message's page range;
+    the ranges are then copied into the output PDFs in a second pass, which
+    runs lazily as the returned iterator is consumed. The output PDFs are
+    built in memory; nothing is written to disk.
 
     Args:
         input_pdf_path (str): Path to the input PDF file to be processed.
-        output_dir (str): Directory where the individual message PDF files
-                          will be saved.
 
     Returns:
         tuple: A tuple containing:
-            - list: A list of paths to the generated PDF files. Returns an empty
-                    list if no messages are found or an error occurs during
-                    initialization.
+            - iterator or None: Yields a (file name, PDF bytes) tuple per message.
+                                None if no messages are found or an error occurs
+                                during the scan. Errors while building the PDFs
+                                are raised by the iterator.
             - str or None: An error message string if a significant error occurs
                            during processing, otherwise None. Returns a specific
                            message if no messages matching the pattern are found.
     """
-    # Ensure the output directory exists.
-    os.makedirs(output_dir, exist_ok=True)
-    print(f"Output directory for split files: '{output_dir}'")
-
-    # Regex to find the message marker (e.g., "Message 1 of 10").
-    # Captures the current message number (group 1) and total messages (group 2).
-    message_pattern = re.compile(r"Message\s+(\d+)\s+of\s+(\d+)")
-
-    # List to store the paths of the generated PDF files.
-    generated_files = []
-
     try:
-        # Open the input PDF file for reading.
-        reader = PdfReader(input_pdf_path)
-        num_pages = len(reader.pages)
-        print(f"Processing '{os.path.basename(input_pdf_path)}' with {num_pages} pages...")
-
-        # --- State variables for tracking messages during page iteration ---
-        current_message_number = 0 # Tracks the message number being currently processed.
-        total_messages_reported = 0 # Stores the total number of messages reported in the markers.
-        pages_for_current_message = [] # Accumulates PageObjects for the current message.
-        last_match = None # Store the last regex match object
-
-        # --- Iterate through each page of the PDF ---
-        for page_num in range(num_pages):
-            page = reader.pages[page_num]
-            try:
-                # Attempt to extract text from the current page.
-                text = page.extract_text()
-                if not text:
-                    # Handle pages where text extraction fails (e.g., image-only pages).
-                    # Assume such pages belong to the currently active message.
-                    print(f"Warning: Could not extract text from page {page_num + 1}. Assuming it belongs to the current message.")
-                    if current_message_number > 0: # Only add if a message has started
-                         pages_for_current_message.append(page)
-                    continue # Move to the next page
-
-                # Search for the message marker pattern in the extracted text.
-                match = message_pattern.search(text)
+        # Open the input PDF file once with PyMuPDF for the text scan. The with
+        # block closes it even if processing fails part way through.
+        with pymupdf.open(input_pdf_path) as src:
+            num_pages = src.page_count
+            print(f"Processing '{os.path.basename(input_pdf_path)}' with {num_pages} pages...")
 
-                if match:
-                    # A message marker was found on this page.
-                    found_message_num = int(match.group(1))
-                    found_total_messages = int(match.group(2))
-                    last_match = match # Store the latest match
-
-                    # Initialize or verify the total message count.
-                    if total_messages_reported == 0:
-                         total_messages_reported = found_total_messages
-                    elif total_messages_reported != found_total_messages:
-                         # Log a warning if the total count changes mid-document.
-                         print(f"Warning: Total message count changed from {total_messages_reported} to {found_total_messages} on page {page_num + 1}")
-                         total_messages_reported = found_total_messages # Update to the latest reported count
-
-                    # Check if this marker indicates the start of a *new* message.
-                    if found_message_num != current_message_number:
-                        # If we have accumulated pages for the *previous* message, write them to a file.
-                        if pages_for_current_message:
-                            # Construct the output filename.
-                            output_filename = f"message_{current_message_number}_of_{total_messages_reported}.pdf"
-                            output_file_path = os.path.join(output_dir, output_filename)
-
-                            # Create a PdfWriter instance and add the collected pages.
-                            writer = PdfWriter()
-                            for msg_page in pages_for_current_message:
-                                writer.add_page(msg_page)
-
-                            # Write the new PDF file.
-                            with open(output_file_path, "wb") as outfile:
-                                writer.write(outfile)
-                            generated_files.append(output_file_path)
-                            print(f"   Saved: {output_filename} ({len(pages_for_current_message)} pages)")
-
-                        # Start accumulating pages for the newly found message.
-                        current_message_number = found_message_num
-                        pages_for_current_message = [page] # Start list with the current page
-                    else:
-                        # This page contains the *same* message marker as the previous one found.
-                        # Add the page to the current message's list if not already added (unlikely but safe).
-                         if page not in pages_for_current_message:
-                             pages_for_current_message.append(page)
-                else:
-                    # No message marker found on this page.
-                    if current_message_number > 0:
-                        # If we are already tracking a message, append this page to it.
-                        pages_for_current_message.append(page)
-                    else:
-                        # This page appears before the very first message marker. Skip it.
-                        print(f"Skipping page {page_num + 1} (appears before first message marker)")
-
-            except Exception as page_ex:
-                # Handle errors during processing of a single page.
-                print(f"Error processing page {page_num + 1}: {page_ex}")
-                # Continue processing the rest of the PDF.
-                continue
+            # Try to locate every marker directly in the file's bytes first. Only if that
+            # fails, extract the text of all pages up front with pdftotext when available.
+            raw_markers = _scan_raw_markers(input_pdf_path, src)
+            page_texts = None
+            if raw_markers is None:
+                page_texts = _extract_page_texts(input_pdf_path, num_pages)
+            else:
+                print(f"Found {len(raw_markers)} message markers in the raw PDF data.")
+
+            # --- Pass 1: Find the message marker on each page, then group pages into messages ---
+            if raw_markers is not None:
+                # Markers were located via the file's bytes already; no further text is needed.
+                page_markers = [raw_markers.get(page_num) for page_num in range(num_pages)]
+            else:
+                page_markers, skipped_pages = _find_page_markers(src, page_texts, use_raw_prefilter=True)
+                # A marker drawn so that it does not appear literally in the content stream
+                # (e.g. kerned or split strings) is skipped by the prefilter. It then shows
+                # up as a missing message number, so scan again extracting every page.
+                if skipped_pages and not _markers_complete(page_markers):
+                    print(f"Warning: Markers incomplete after skipping {skipped_pages} pages by their raw content. Re-scanning with full text extraction.")
+                    page_markers, _ = _find_page_markers(src, page_texts, use_raw_prefilter=False)
+                # The header search follows content stream order, which need not put the
+                # page header first. If markers are still missing, search each page's full
+                # text, as long as that accounts for every message.
+                if not _markers_complete(page_markers):
+                    full_markers, _ = _find_page_markers(src, page_texts, use_raw_prefilter=False,
+                                                         header_only=False)
+                    if _markers_complete(full_markers):
+                        print("Warning: Markers incomplete in the page headers. Using markers found in the full page text.")
+                        page_markers = full_markers
 
-        # --- After the loop: Save the pages for the very last message ---
-        if pages_for_current_message and current_message_number > 0:
-            # Ensure total_messages_reported is sensible even if the last page didn't have a clear marker
-            # (e.g., if the very last message only had one page which had the marker).
-            if total_messages_reported == 0 and last_match:
-                total_messages_reported = int(last_match.group(2))
-            elif total_messages_reported == 0:
-                 print("Warning: Could not determine total message count for the last message.")
-                 total_messages_reported = 'X' # Use a placeholder if count is unknown
-
-            # Construct filename and path for the last message.
-            output_filename = f"message_{current_message_number}_of_{total_messages_reported}.pdf"
-            output_file_path = os.path.join(output_dir, output_filename)
-
-            # Create PdfWriter, add pages, and write the file.
-            writer = PdfWriter()
-            for msg_page in pages_for_current_message:
-                writer.add_page(msg_page)
-            with open(output_file_path, "wb") as outfile:
-                writer.write(outfile)
-            generated_files.append(output_file_path)
-            print(f"   Saved: {output_filename} ({len(pages_for_current_message)} pages)")
+            # Page ranges found by the scan, as (start_page, end_page, message_number, total_messages).
+            boundaries = find_message_boundaries(page_markers)
 
         # --- Final checks and return ---
-        if not generated_files:
-            # If no files were created, it means no markers were found.
-            return [], "No messages found matching the pattern 'Message X of Y'."
+        if not boundaries:
+            # If no ranges were found, it means no markers were found.
+            return None, "No messages found matching the pattern 'Message X of Y'."
 
-        # Successfully processed, return the list of generated file paths.
-        return generated_files, None
+        # --- Pass 2: Copy each message's page range into its own PDF ---
+        # The PDFs are built as the caller consumes them, so they are never all in memory at once.
+        print(f"Found {len(boundaries)} messages.")
+        return _generate_messages(input_pdf_path, boundaries), None
 
     except Exception as e:
         # Handle major errors during PDF processing (e.g., file corruption, library issues).
         print(f"\nAn error occurred during PDF processing: {e}")
         import traceback
         traceback.print_exc() # Log detailed traceback to server console
-        # Return an empty list and the error message for flashing to the user.
-        return [], f"An error occurred during PDF processing: {e}"
+        # Return no messages and the error message to report to the user.
+        return None, f"An error occurred during PDF processing: {e}"
+
+# --- Background Jobs ---
+
+def _job_dir(job_id):
+    """
+    Returns the directory of a job, rejecting malformed job IDs.
+
+    Args:
+        job_id (str): The job ID taken from the request URL.
+
+    Returns:
+        str or None: The job's directory, or None if the ID is not valid.
+    """
+    if not JOB_ID_RE.fullmatch(job_id):
+        return None
+    return os.path.join(app.config['JOB_DIR'], job_id)
+
+def _zip_path(job_dir):
+    """Returns the path of the finished ZIP archive inside a job directory."""
+    return os.path.join(job_dir, 'messages.zip')
+
+def _file_digest(path):
+    """
+    Computes the job ID of an uploaded file from its contents and JOB_ID_KEY.
+
+    Args:
+        path (str): Path to the uploaded file.
+
+    Returns:
+        str: The 32 character hex keyed BLAKE2b digest of the file.
+    """
+    digest = hashlib.blake2b(digest_size=16, key=JOB_ID_KEY)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_COPY_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _owner_path(job_dir):
+    """Returns the path of the file naming the process that runs an inline job."""
+    return os.path.join(job_dir, 'owner')
+
+def _inline_job_alive(job_dir):
+    """
+    Checks whether the process that started an inline job is still running it.
+
+    A request killed part way through (e.g. by the WSGI server's timeout) leaves
+    its job directory behind without an archive. The job counts as running only
+    while its owner process exists and for at most JOB_TIMEOUT_SECONDS.
+
+    Args:
+        job_dir (str): The job's directory.
+
+    Returns:
+        bool: True if the job may still finish; False if it was interrupted.
+    """
+    owner_path = _owner_path(job_dir)
+    try:
+        with open(owner_path) as f:
+            host, pid = f.read().rsplit(':', 1)
+        started = os.path.getmtime(owner_path)
+    except (OSError, ValueError):
+        return False
+    if time.time() - started > JOB_TIMEOUT_SECONDS:
+        return False
+    # Processes on other hosts sharing JOB_DIR cannot be checked, and on Windows
+    # os.kill() terminates the process; both rely on the time limit alone.
+    if host != socket.gethostname() or os.name == 'nt':
+        return True
+    try:
+        os.kill(int(pid), 0) # Signal 0 only checks that the process exists.
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass # Exists, but is owned by another user.
+    return True
+
+def _job_in_progress(job_id, job_dir):
+    """
+    Checks whether an existing job without an archive is still being processed.
+
+    Args:
+        job_id (str): The job ID.
+        job_dir (str): The job's directory.
+
+    Returns:
+        bool: True if the job is queued or running; False if it has failed and
+              may be started again.
+    """
+    if not os.path.isdir(job_dir):
+        return False
+    if task_queue is None:
+        # Inline jobs remove their directory when they fail, unless the request was interrupted.
+        return _inline_job_alive(job_dir)
+    job = task_queue.fetch_job(job_id)
+    return job is not None and job.get_status() in ('queued', 'started', 'deferred', 'scheduled')
+
+def _lock_path(job_dir):
+    """Returns the path of the lock file guarding the claim of a job directory."""
+    return job_dir + '.lock'
+
+def _try_lock(fd):
+    """
+    Takes an exclusive lock on an open file without waiting.
+
+    The lock is held until the file is closed, and the operating system releases
+    it if the process dies, so a killed worker never leaves a job locked.
+
+    Args:
+        fd (int): File descriptor of the lock file.
+
+    Returns:
+        bool: True if the lock was taken; False if another process holds it.
+    """
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+def _acquire_claim_lock(job_id, job_dir):
+    """
+    Locks a job directory's lock file, waiting for other uploads of the same file.
+
+    Args:
+        job_id (str): The job ID.
+        job_dir (str): The job's directory.
+
+    Returns:
+        int: File descriptor of the locked lock file. Closing it releases the lock.
+
+    Raises:
+        TimeoutError: If the lock is not released within JOB_CLAIM_WAIT_SECONDS.
+    """
+    lock_path = _lock_path(job_dir)
+    deadline = time.monotonic() + JOB_CLAIM_WAIT_SECONDS
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        if _try_lock(fd):
+            # The sweeper may have removed the lock file between opening and locking
+            # it; a lock on a removed file excludes nobody, so retry with a new one.
+            try:
+                if os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                    return fd
+            except FileNotFoundError:
+                pass
+        os.close(fd)
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'Timed out waiting to claim job {job_id}')
+        time.sleep(0.05)
+
+def _claim_job(staging_dir, job_id, job_dir):
+    """
+    Moves a staged upload into its job directory, unless the job is already
+    finished or in progress. With a task queue, the job is also queued.
+
+    Identical uploads may arrive at the same time, so the check, the move and
+    queueing the job are done while holding a lock on the job's lock file;
+    otherwise another upload could see the directory before its job is queued
+    and take it for a failed one. A failed or interrupted earlier attempt is
+    moved out of the way first, so the staged upload is only ever renamed onto
+    a missing target. A reused job is marked as recently used before the lock
+    is released.
+
+    Args:
+        staging_dir (str): The staging directory holding the upload.
+        job_id (str): The job ID.
+        job_dir (str): The job's directory.
+
+    Returns:
+        bool: True if the upload now owns the job directory; False if an earlier
+              job is reused instead.
+
+    Raises:
+        TimeoutError: If the lock is not released within JOB_CLAIM_WAIT_SECONDS.
+    """
+    lock_fd = _acquire_claim_lock(job_id, job_dir)
+    stale_dir = None
+    try:
+        if os.path.exists(_zip_path(job_dir)) or _job_in_progress(job_id, job_dir):
+            try:
+                # Mark the job as recently used while the lock is held, so the
+                # sweeper keeps it longer.
+                os.utime(job_dir)
+                return False
+            except FileNotFoundError:
+                pass # Evicted by the sweeper in the meantime; claim the job afresh.
+        if os.path.isdir(job_dir):
+            # The staging directory's name is unique, so the failed attempt cannot collide.
+            stale_dir = staging_dir + '-stale'
+            os.rename(job_dir, stale_dir)
+        os.rename(staging_dir, job_dir)
+        # mkdtemp creates the staging directory accessible by its owner only. A
+        # front-end server sending the archive through X-Accel-Redirect/X-Sendfile
+        # usually runs as another user, so it is given group access to the
+        # directory. The uploaded PDF itself stays private.
+        if _front_end_sends_archives():
+            os.chmod(job_dir, 0o750)
+        if task_queue is not None:
+            try:
+                task_queue.enqueue(split_and_zip, os.path.join(job_dir, 'upload.pdf'),
+                                   _zip_path(job_dir), job_id=job_id,
+                                   job_timeout=JOB_TIMEOUT_SECONDS, result_ttl=JOB_TTL_SECONDS,
+                                   failure_ttl=JOB_TTL_SECONDS)
+            except Exception:
+                _remove_dir(job_dir)
+                raise
+            print(f"Queued job {job_id}")
+        return True
+    finally:
+        os.close(lock_fd)
+        _remove_dir(stale_dir)
+
+def _remove_lock_file(lock_path):
+    """
+    Removes a job's lock file, unless an upload is claiming the job right now.
+
+    Args:
+        lock_path (str): Path of the lock file.
+    """
+    fd = os.open(lock_path, os.O_RDWR)
+    try:
+        if _try_lock(fd):
+            # Uploads that opened the file before it is removed notice this and retry.
+            os.remove(lock_path)
+    finally:
+        os.close(fd)
+
+def _sweep_expired_jobs():
+    """
+    Removes job directories and unused lock files older than JOB_TTL_SECONDS,
+    then the least recently used finished jobs beyond MAX_CACHED_JOBS.
+
+    Called on every upload, so finished archives do not accumulate even if they
+    are never downloaded. A job directory's modification time is refreshed
+    whenever its archive is reused.
+    """
+    jobs_root = app.config['JOB_DIR']
+    if not os.path.isdir(jobs_root):
+        return
+    cutoff = time.time() - JOB_TTL_SECONDS
+    finished = []
+    for entry in os.scandir(jobs_root):
+        try:
+            if entry.name.endswith('.lock') and entry.is_file():
+                if entry.stat().st_mtime < cutoff:
+                    _remove_lock_file(entry.path)
+                continue
+            if not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime
+            if mtime < cutoff:
+                _remove_dir(entry.path)
+            elif os.path.exists(_zip_path(entry.path)):
+                finished.append((mtime, entry.path))
+        except OSError:
+            continue # Removed concurrently by another worker.
+
+    finished.sort(reverse=True) # Most recently used first.
+    for _, path in finished[MAX_CACHED_JOBS:]:
+        _remove_dir(path)
+
+def _job_response(job_id, zip_filename):
+    """
+    Builds the upload route's JSON response for a job.
+
+    Args:
+        job_id (str): The job ID.
+        zip_filename (str): File name suggested for the downloaded archive.
+
+    Returns:
+        tuple: The JSON response and the 202 Accepted status code.
+    """
+    return jsonify(
+        job_id=job_id,
+        status_url=url_for('job_status', job_id=job_id),
+        download_url=url_for('download', job_id=job_id, name=zip_filename),
+    ), 202
+
+def split_and_zip(upload_path, zip_path):
+    """
+    Splits an uploaded PDF and writes the messages to a ZIP archive.
+
+    This is the unit of work run by the queue workers (or inline when no queue
+    is configured). The uploaded PDF is deleted once it has been processed.
+
+    Args:
+        upload_path (str): Path to the uploaded PDF file.
+        zip_path (str): Path of the ZIP archive to create.
+
+    Returns:
+        str or None: An error message if no archive was created, otherwise None.
+    """
+    try:
+        # --- 1. Split the PDF ---
+        print(f"Splitting PDF: {upload_path}")
+        split_files, error = split_messages_pdf(upload_path)
+
+        # Handle errors reported by the splitting function, including the case
+        # where no messages matching the pattern were found.
+        if error:
+            return f'Error splitting PDF: {error}'
+
+        # --- 2. Create the ZIP Archive ---
+        print("Zipping split files...")
+        # Write to a unique temporary file first, so the archive only appears under
+        # its final name (which marks the job as finished) once it is complete.
+        fd, partial_path = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(zip_path))
+        try:
+            # The PDFs are already Flate-compressed internally, so they are stored without recompressing.
+            with os.fdopen(fd, 'wb') as f, zipfile.ZipFile(f, 'w', zipfile.ZIP_STORED) as zf:
+                # Add each generated PDF to the zip archive straight from memory as soon as it is built.
+                for arcname, pdf_bytes in split_files:
+                    print(f"  Adding to zip: {arcname}")
+                    zf.writestr(arcname, pdf_bytes)
+            # mkstemp creates the file readable by its owner only; a front-end server
+            # sending it through X-Accel-Redirect/X-Sendfile needs group read access.
+            if _front_end_sends_archives():
+                os.chmod(partial_path, 0o640)
+            os.replace(partial_path, zip_path)
+        except Exception as e:
+            # The messages are built while the archive is written, so build errors surface here.
+            print(f"\nAn error occurred while creating the ZIP archive: {e}")
+            import traceback
+            traceback.print_exc() # Log detailed traceback to server console
+            try:
+                os.remove(partial_path)
+            except OSError:
+                pass
+            return f'Error splitting PDF: An error occurred during PDF processing: {e}'
+        print(f"Created zip file: {zip_path}")
+        return None
+
+    finally:
+        # The uploaded PDF is no longer needed, whether or not splitting succeeded.
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
 
 # --- Flask Routes ---
 
@@ -225,130 +1016,193 @@ def index():
 def upload_file():
     """
     Handles the file upload via POST request.
-    Performs validation, saves the uploaded file temporarily, calls the PDF
-    splitting function, zips the results, and sends the zip file for download.
-    Includes error handling and cleanup of temporary files.
+    Performs validation, saves the uploaded file to a new job directory, and
+    queues the job that splits and zips it. Responds with JSON containing the
+    job ID and the URLs used to poll its status and download the result.
+    Errors are reported as JSON with an 'error' key.
     """
     # --- 1. Validate Request ---
     # Check if the POST request has the 'pdf_file' part.
     if 'pdf_file' not in request.files:
-        flash('No file part selected.')
-        return redirect(request.url) # Redirect back to the upload form
+        return jsonify(error='No file part selected.'), 400
 
     file = request.files['pdf_file']
 
     # Check if the user selected a file. The browser might send an empty
     # file part if no file was selected.
     if file.filename == '':
-        flash('No file selected.')
-        return redirect(request.url)
+        return jsonify(error='No file selected.'), 400
+
+    # Handle invalid file type uploads.
+    if not allowed_file(file.filename):
+        return jsonify(error='Invalid file type. Please upload a PDF.'), 400
 
     # --- 2. Process Valid File ---
-    if file and allowed_file(file.filename):
-        # Sanitize the filename to prevent directory traversal issues.
-        original_filename = secure_filename(file.filename)
-        # Get the base name for naming the output zip file.
-        base_filename = os.path.splitext(original_filename)[0]
-
-        # --- Use Temporary Directories for Safety and Cleanup ---
-        temp_dir = None # Initialize to ensure cleanup block works even if mkdtemp fails
+    # Sanitize the filename to prevent directory traversal issues.
+    original_filename = secure_filename(file.filename)
+    # Get the base name for naming the output zip file.
+    base_filename = os.path.splitext(original_filename)[0] or 'report'
+    zip_filename = f"{base_filename}_messages.zip"
+
+    # Remove old jobs before creating a new one.
+    _sweep_expired_jobs()
+
+    # --- Use a Unique Staging Directory for Safety and Cleanup ---
+    # The job ID depends on the file's contents, so the upload is saved to a
+    # staging directory first and moved to its job directory once it is hashed.
+    staging_dir = None
+    owned_job_dir = None # Job directory created by this request, removed if it fails
+    try:
+        # Recreated (and checked again) in case it was removed since startup.
+        _prepare_job_root(app.config['JOB_DIR'])
+        staging_dir = tempfile.mkdtemp(prefix='upload-', dir=app.config['JOB_DIR'])
+        upload_path = os.path.join(staging_dir, 'upload.pdf')
+
+        # --- 3. Save Uploaded File ---
+        print(f"Saving uploaded file to: {upload_path}")
+        _save_upload(file, upload_path)
+
+        # Reject files that are not PDFs or are too long before queueing any work.
         try:
-            # Create a unique temporary directory for this request's files.
-            # This prevents conflicts between concurrent requests and aids cleanup.
-            temp_dir = tempfile.mkdtemp()
-            upload_path = os.path.join(temp_dir, original_filename)
-            # Create a subdirectory within the temp dir for split PDF files.
-            output_split_dir = os.path.join(temp_dir, 'output')
-
-            # --- 3. Save Uploaded File Temporarily ---
-            print(f"Saving uploaded file temporarily to: {upload_path}")
-            file.save(upload_path)
-
-            # --- 4. Split the PDF ---
-            print(f"Splitting PDF: {upload_path}")
-            split_files, error = split_messages_pdf(upload_path, output_split_dir)
-
-            # Handle errors reported by the splitting function.
+            with pymupdf.open(upload_path) as doc:
+                page_count = doc.page_count
+        except Exception as e:
+            print(f"Rejected upload that could not be opened as a PDF: {e}")
+            _remove_dir(staging_dir)
+            return jsonify(error='The uploaded file could not be read as a PDF.'), 400
+        if page_count > MAX_PAGES:
+            _remove_dir(staging_dir)
+            return jsonify(error=f'The PDF has {page_count} pages; at most {MAX_PAGES} are supported.'), 413
+
+        # Record which process runs an inline job, so identical uploads can tell
+        # whether it is still being processed.
+        if task_queue is None:
+            with open(_owner_path(staging_dir), 'w', opener=_open_private) as f:
+                f.write(f"{socket.gethostname()}:{os.getpid()}")
+
+        # --- 4. Reuse the Result of an Identical Earlier Upload ---
+        job_id = _file_digest(upload_path)
+        job_dir = _job_dir(job_id)
+        zip_path = _zip_path(job_dir)
+        # Any failed or interrupted earlier attempt is replaced with this upload.
+        # With a queue, claiming the job also queues it.
+        if not _claim_job(staging_dir, job_id, job_dir):
+            print(f"Reusing job {job_id} for an identical upload")
+            _remove_dir(staging_dir)
+            return _job_response(job_id, zip_filename)
+        staging_dir = None
+        owned_job_dir = job_dir
+        upload_path = os.path.join(job_dir, 'upload.pdf')
+
+        # --- 5. Without a Queue, Run the Split Now (queued jobs were queued by the claim) ---
+        if task_queue is None:
+            error = split_and_zip(upload_path, zip_path)
             if error:
-                flash(f'Error splitting PDF: {error}') # Display the error to the user
-                # Note: Consider logging the full error server-side and showing a generic user message.
-                return redirect(url_for('index'))
-
-            # Handle case where splitting succeeded but found no messages.
-            if not split_files:
-                # This case is now handled by the 'error' variable check above based on split_messages_pdf return
-                # flash('Could not find any messages matching the pattern "Message X of Y" in the PDF.')
-                # return redirect(url_for('index'))
-                # Kept comment for clarity, but logic moved. If split_files is empty and error is None,
-                # the zip creation below will handle it gracefully (empty zip).
-                # Let's refine the check based on the improved return value:
-                 if not split_files and not error: # Check if function returned empty list AND no error string
-                     flash('Splitting process completed, but no messages matching the pattern "Message X of Y" were found.')
-                     return redirect(url_for('index'))
-
-
-            # --- 5. Create ZIP Archive in Memory ---
-            print(f"Zipping {len(split_files)} split files...")
-            # Use an in-memory bytes buffer to avoid writing the zip file to disk.
-            zip_buffer = io.BytesIO()
-            # Create a ZipFile object operating on the buffer.
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-                # Add each generated PDF file to the zip archive.
-                for fpath in split_files:
-                    arcname = os.path.basename(fpath) # Use the file's base name as its name inside the zip.
-                    print(f"  Adding to zip: {fpath} as {arcname}")
-                    zf.write(fpath, arcname=arcname)
-
-            # Reset the buffer's position to the beginning for reading.
-            zip_buffer.seek(0)
-
-            # --- 6. Send ZIP File for Download ---
-            zip_filename = f"{base_filename}_messages.zip"
-            print(f"Sending zip file: {zip_filename}")
-            # Use send_file to send the contents of the memory buffer as a downloadable file.
-            return send_file(
-                zip_buffer,
-                as_attachment=True, # Send as attachment to prompt download.
-                download_name=zip_filename, # Suggest a filename to the browser.
-                mimetype='application/zip' # Set the correct MIME type.
-            )
+                _remove_dir(job_dir)
+                return jsonify(error=error), 422
 
-        except Exception as e:
-            # Catch any unexpected errors during the upload/processing/zipping.
-            print(f"An error occurred in the upload route: {e}")
-            import traceback
-            traceback.print_exc() # Log the full traceback for debugging.
-            # Provide a generic error message to the user.
-            flash(f'An unexpected error occurred: {e}') # Consider more generic message for production.
-            return redirect(url_for('index'))
+    except Exception as e:
+        # Catch any unexpected errors during the upload/queueing/processing.
+        print(f"An error occurred in the upload route: {e}")
+        import traceback
+        traceback.print_exc() # Log the full traceback for debugging.
+        _remove_dir(staging_dir)
+        _remove_dir(owned_job_dir)
+        # Provide a generic error message to the user.
+        return jsonify(error=f'An unexpected error occurred: {e}'), 500 # Consider more generic message for production.
 
-        finally:
-            # --- 7. Cleanup: ALWAYS remove the temporary directory and its contents ---
-            # This block executes whether the try block succeeded or failed.
-            if temp_dir and os.path.exists(temp_dir):
-                print(f"Cleaning up temporary directory: {temp_dir}")
-                try:
-                    shutil.rmtree(temp_dir) # Recursively delete the directory.
-                    print("Temporary directory cleaned up successfully.")
-                except Exception as cleanup_error:
-                    # Log errors during cleanup, but don't interrupt the user flow.
-                    print(f"Error cleaning up temporary directory {temp_dir}: {cleanup_error}")
-                    # Consider using app.logger for production logging.
-
-    else:
-        # Handle invalid file type uploads.
-        flash('Invalid file type. Please upload a PDF.')
-        return redirect(request.url)
+    return _job_response(job_id, zip_filename)
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    """
+    Reports uploads larger than MAX_CONTENT_LENGTH as JSON, like other upload errors.
+    """
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify(error=f'The file is too large. The maximum upload size is {limit_mb} MB.'), 413
+
+@app.route('/status/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Reports the state of a job as JSON.
+
+    The 'status' key is one of 'queued', 'started', 'finished' or 'failed'
+    (with an 'error' message). Unknown or expired jobs return 404.
+    """
+    job_dir = _job_dir(job_id)
+    if job_dir is None:
+        abort(404)
+
+    # A finished archive is authoritative, whichever way the job was run.
+    if os.path.exists(_zip_path(job_dir)):
+        return jsonify(status='finished')
+
+    if task_queue is None:
+        # Inline jobs remove their directory when they fail, so an existing one is
+        # an identical upload being processed by another request, unless that
+        # request was interrupted.
+        if not os.path.isdir(job_dir):
+            abort(404)
+        if _inline_job_alive(job_dir):
+            return jsonify(status='started')
+        return jsonify(status='failed', error='Processing was interrupted. Please upload the file again.')
+
+    job = task_queue.fetch_job(job_id)
+    if job is None:
+        abort(404)
+
+    status = job.get_status()
+    if status == 'finished':
+        # The job ran but split_and_zip reported an error instead of creating the archive.
+        return jsonify(status='failed', error=job.return_value() or 'No archive was created.')
+    if status in ('failed', 'stopped', 'canceled'):
+        return jsonify(status='failed', error='An unexpected error occurred while processing the PDF.')
+    return jsonify(status='started' if status == 'started' else 'queued')
+
+@app.route('/download/<job_id>', methods=['GET'])
+def download(job_id):
+    """
+    Sends the finished ZIP archive of a job as a download.
+
+    The suggested file name is taken from the 'name' query parameter, as
+    returned by the upload route.
+    """
+    job_dir = _job_dir(job_id)
+    if job_dir is None or not os.path.exists(_zip_path(job_dir)):
+        abort(404)
+
+    zip_filename = secure_filename(request.args.get('name', '')) or 'messages.zip'
+    print(f"Sending zip file: {zip_filename}")
+
+    accel_prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if accel_prefix:
+        # nginx serves the file itself from its internal location; the worker is freed at once.
+        return Response(headers={
+            'X-Accel-Redirect': f"{accel_prefix.rstrip('/')}/{job_id}/{os.path.basename(_zip_path(job_dir))}",
+            'Content-Disposition': f'attachment; filename="{zip_filename}"',
+            'Content-Type': 'application/zip',
+        })
+
+    # With USE_X_SENDFILE enabled, send_file only emits an X-Sendfile header.
+    return send_file(
+        _zip_path(job_dir),
+        as_attachment=True, # Send as attachment to prompt download.
+        download_name=zip_filename, # Suggest a filename to the browser.
+        mimetype='application/zip' # Set the correct MIME type.
+    )
 
 # --- Main Execution Block ---
 
 if __name__ == '__main__':
     # This block runs only when the script is executed directly (not imported).
-    # It's typically used for starting the Flask development server.
+    # It starts the Werkzeug development server, which is only meant for local use.
+    # In production, serve the app with a WSGI server running several worker
+    # processes instead, e.g. `gunicorn wsgi:app` (see wsgi.py and Procfile).
 
-    # WARNING: debug=True enables the Werkzeug debugger and auto-reloader.
+    # WARNING: debug mode enables the Werkzeug debugger and auto-reloader.
     # This is useful for development but EXTREMELY DANGEROUS in production.
-    # It allows arbitrary code execution if an error occurs.
-    # Set debug=False or remove it entirely when deploying.
-    # Use a proper WSGI server (like Gunicorn or uWSGI) for deployment instead of app.run().
-    app.run(debug=True)
+    # It allows arbitrary code execution if an error occurs, so it is only
+    # enabled when FLASK_DEBUG=1 is set explicitly.
+    # Requests are handled one at a time, as inline jobs run PyMuPDF, which is
+    # not thread-safe.
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', threaded=False)
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Builds the optional C extension for the page grouping loop in _ofw_scan.py.
+
+    pip install cython
+    python setup.py build_ext --inplace
+
+The application works without it; the plain Python module is used instead.
+The built extension takes precedence over _ofw_scan.py, so rebuild it (or
+delete the _ofw_scan*.so/.pyd file) after editing the module.
+"""
+
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='ofw-message-extractor-scan',
+    ext_modules=cythonize(['_ofw_scan.py'], compiler_directives={'language_level': 3}),
+)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Test setup: makes the application modules importable and points JOB_DIR at a
+private temporary directory before app.py is imported.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['OFW_JOB_DIR'] = os.path.join(tempfile.mkdtemp(), 'ofw_jobs')
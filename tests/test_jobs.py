@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the job lifecycle in inline mode (no task queue), using Flask's test client.
+"""
+
+import hashlib
+import io
+import os
+import socket
+import subprocess
+import sys
+import time
+import zipfile
+
+import pymupdf
+import pytest
+
+import app
+
+
+def _report_bytes(total=2):
+    """Returns a small Message Report with one page per message."""
+    doc = pymupdf.open()
+    for number in range(1, total + 1):
+        doc.new_page().insert_text((72, 72), f"Message {number} of {total}")
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def _upload(client, pdf_bytes):
+    return client.post('/upload', data={'pdf_file': (io.BytesIO(pdf_bytes), 'report.pdf')},
+                       content_type='multipart/form-data')
+
+
+def _dead_pid():
+    """Returns the PID of a process that has already exited."""
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def _make_job(job_id, finished=False, owner_pid=None, age=0):
+    """Creates a job directory by hand, as an earlier upload would have left it."""
+    job_dir = app._job_dir(job_id)
+    os.makedirs(job_dir)
+    if finished:
+        with zipfile.ZipFile(app._zip_path(job_dir), 'w'):
+            pass
+    if owner_pid is not None:
+        with open(app._owner_path(job_dir), 'w') as f:
+            f.write(f"{socket.gethostname()}:{owner_pid}")
+    mtime = time.time() - age
+    os.utime(job_dir, (mtime, mtime))
+    return job_dir
+
+
+@pytest.fixture(autouse=True)
+def jobs_root(tmp_path, monkeypatch):
+    """Gives each test its own empty JOB_DIR and runs jobs inline."""
+    root = str(tmp_path / 'jobs')
+    monkeypatch.setitem(app.app.config, 'JOB_DIR', root)
+    monkeypatch.setattr(app, 'task_queue', None)
+    app._prepare_job_root(root)
+    return root
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def split_calls(monkeypatch):
+    """Records the upload paths split_and_zip is called with."""
+    calls = []
+    split_and_zip = app.split_and_zip
+
+    def recording_split_and_zip(upload_path, zip_path):
+        calls.append(upload_path)
+        return split_and_zip(upload_path, zip_path)
+
+    monkeypatch.setattr(app, 'split_and_zip', recording_split_and_zip)
+    return calls
+
+
+def test_upload_creates_archive(client):
+    response = _upload(client, _report_bytes())
+    assert response.status_code == 202
+    assert client.get(response.json['status_url']).json == {'status': 'finished'}
+
+    download = client.get(response.json['download_url'])
+    assert download.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(download.data)) as zf:
+        assert zf.namelist() == ['message_1_of_2.pdf', 'message_2_of_2.pdf']
+
+
+def test_repeat_upload_reuses_job(client, split_calls):
+    pdf_bytes = _report_bytes()
+    first = _upload(client, pdf_bytes)
+    job_dir = app._job_dir(first.json['job_id'])
+    used = time.time() - 600
+    os.utime(job_dir, (used, used))
+
+    second = _upload(client, pdf_bytes)
+    assert second.status_code == 202
+    assert second.json['job_id'] == first.json['job_id']
+    assert len(split_calls) == 1
+    # Reuse marks the job as recently used.
+    assert os.path.getmtime(job_dir) > used
+
+
+def test_job_ids_are_keyed(tmp_path):
+    path = tmp_path / 'report.pdf'
+    path.write_bytes(_report_bytes())
+    job_id = app._file_digest(str(path))
+    assert app.JOB_ID_RE.fullmatch(job_id)
+    assert job_id != hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()
+
+
+def test_interrupted_job_is_replaced(client, split_calls, tmp_path):
+    pdf_bytes = _report_bytes()
+    path = tmp_path / 'report.pdf'
+    path.write_bytes(pdf_bytes)
+    job_id = app._file_digest(str(path))
+    # An earlier request was killed part way through, leaving its directory behind.
+    _make_job(job_id, owner_pid=_dead_pid())
+
+    response = _upload(client, pdf_bytes)
+    assert response.status_code == 202
+    assert response.json['job_id'] == job_id
+    assert len(split_calls) == 1
+    assert client.get(response.json['status_url']).json == {'status': 'finished'}
+
+
+def test_failed_job_is_removed_and_retried(client, split_calls, monkeypatch):
+    pdf_bytes = _report_bytes()
+    split_messages_pdf = app.split_messages_pdf
+    monkeypatch.setattr(app, 'split_messages_pdf', lambda path: (None, 'broken'))
+    response = _upload(client, pdf_bytes)
+    assert response.status_code == 422
+    assert not any(entry.is_dir() for entry in os.scandir(app.app.config['JOB_DIR']))
+
+    monkeypatch.setattr(app, 'split_messages_pdf', split_messages_pdf)
+    response = _upload(client, pdf_bytes)
+    assert response.status_code == 202
+    assert len(split_calls) == 2
+
+
+def test_status_of_dead_owner_is_failed(client):
+    job_id = 'a' * 32
+    _make_job(job_id, owner_pid=_dead_pid())
+    status = client.get(f'/status/{job_id}').json
+    assert status['status'] == 'failed'
+
+
+def test_status_of_live_owner_is_started(client):
+    job_id = 'b' * 32
+    _make_job(job_id, owner_pid=os.getpid())
+    assert client.get(f'/status/{job_id}').json == {'status': 'started'}
+
+
+def test_status_of_unknown_job_is_404(client):
+    assert client.get(f"/status/{'c' * 32}").status_code == 404
+    assert client.get('/status/not-a-job').status_code == 404
+
+
+def test_sweep_removes_expired_jobs():
+    expired = _make_job('d' * 32, finished=True, age=app.JOB_TTL_SECONDS + 60)
+    recent = _make_job('e' * 32, finished=True)
+    app._sweep_expired_jobs()
+    assert not os.path.exists(expired)
+    assert os.path.exists(recent)
+
+
+def test_sweep_evicts_least_recently_used_beyond_limit(monkeypatch):
+    monkeypatch.setattr(app, 'MAX_CACHED_JOBS', 2)
+    oldest = _make_job('1' * 32, finished=True, age=30)
+    older = _make_job('2' * 32, finished=True, age=20)
+    newest = _make_job('3' * 32, finished=True, age=10)
+    # Jobs without an archive do not count towards the limit.
+    running = _make_job('4' * 32, owner_pid=os.getpid())
+    app._sweep_expired_jobs()
+    assert not os.path.exists(oldest)
+    assert os.path.exists(older)
+    assert os.path.exists(newest)
+    assert os.path.exists(running)
+
+
+def test_sweep_removes_expired_lock_files():
+    job_dir = app._job_dir('f' * 32)
+    os.close(app._acquire_claim_lock('f' * 32, job_dir))
+    lock_path = app._lock_path(job_dir)
+    os.utime(lock_path, (0, 0))
+    app._sweep_expired_jobs()
+    assert not os.path.exists(lock_path)
+
+
+def test_claim_waits_for_lock_holder(monkeypatch):
+    monkeypatch.setattr(app, 'JOB_CLAIM_WAIT_SECONDS', 0.2)
+    job_dir = app._job_dir('0' * 32)
+    lock_fd = app._acquire_claim_lock('0' * 32, job_dir)
+    try:
+        with pytest.raises(TimeoutError):
+            app._acquire_claim_lock('0' * 32, job_dir)
+    finally:
+        os.close(lock_fd)
+    # Released once the holder closes it (or its process dies).
+    os.close(app._acquire_claim_lock('0' * 32, job_dir))
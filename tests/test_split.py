@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the marker scan and page grouping, using small generated PDFs.
+
+The pages are written with literal strings in their content streams, so the
+raw-bytes scan can find the markers when the PDF is saved uncompressed.
+"""
+
+import pymupdf
+import pytest
+
+import app
+from _ofw_scan import find_message_boundaries
+
+# Filler for the body of a page, long enough to push later text past MARKER_SEARCH_CHARS.
+BODY_LINES = [f"Line {i} of the message body, with some ordinary text in it." for i in range(12)]
+
+
+def _text_stream(lines):
+    """Returns a content stream drawing each line as a literal string, one per row."""
+    ops = [b"BT /helv 11 Tf 14 TL 72 770 Td"]
+    for line in lines:
+        ops.append(line if isinstance(line, bytes) else b"(" + line.encode() + b") Tj T*")
+    ops.append(b"ET")
+    return b"\n".join(ops)
+
+
+def _make_pdf(path, pages, compress):
+    """
+    Writes a PDF with one page per entry of `pages`, each a list of text lines.
+
+    A line given as bytes is copied into the content stream as is (e.g. a TJ array).
+    """
+    doc = pymupdf.open()
+    for lines in pages:
+        page = doc.new_page()
+        # Registers the font resource and creates the page's content stream.
+        page.insert_text((72, 72), " ", fontname="helv")
+        doc.update_stream(page.get_contents()[0], _text_stream(lines), compress=False)
+    doc.save(path, deflate=compress)
+    doc.close()
+
+
+def _split(path):
+    """Splits a PDF, returning (file name, page count) for each message."""
+    messages, error = app.split_messages_pdf(str(path))
+    assert error is None
+    result = []
+    for name, pdf_bytes in messages:
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+            result.append((name, doc.page_count))
+    return result
+
+
+@pytest.fixture(autouse=True)
+def no_pdftotext(monkeypatch):
+    """Uses PyMuPDF's per-page extraction whether or not pdftotext is installed."""
+    monkeypatch.setattr(app, "_extract_page_texts", lambda input_pdf_path, num_pages: None)
+
+
+# Three messages; the second one continues on a page without a marker.
+REPORT_PAGES = [
+    ["Message 1 of 3"] + BODY_LINES,
+    ["Message 2 of 3"] + BODY_LINES,
+    BODY_LINES,
+    ["Message 3 of 3"] + BODY_LINES,
+]
+
+EXPECTED_SPLIT = [
+    ("message_1_of_3.pdf", 1),
+    ("message_2_of_3.pdf", 2),
+    ("message_3_of_3.pdf", 1),
+]
+
+
+def test_markers_complete():
+    assert app._markers_complete([(1, 2), None, (2, 2)])
+    assert not app._markers_complete([(1, 3), None, (3, 3)])
+    assert not app._markers_complete([(1, 2), (2, 3)])
+    assert not app._markers_complete([None, None])
+    assert not app._markers_complete([])
+
+
+def test_markers_complete_with_huge_total():
+    # The total comes from the PDF; it must not size anything that is built.
+    assert not app._markers_complete([(1, 999999999999)])
+    assert not app._markers_complete([(1, 10**7), (2, 10**7)])
+
+
+def test_find_message_boundaries():
+    markers = [None, (1, 3), None, (2, 3), (2, 3), None, (3, 3)]
+    assert find_message_boundaries(markers) == [
+        (1, 2, 1, 3),
+        (3, 5, 2, 3),
+        (6, 6, 3, 3),
+    ]
+
+
+def test_find_message_boundaries_without_markers():
+    assert find_message_boundaries([None, None]) == []
+
+
+def test_uncompressed_pdf_uses_raw_scan(tmp_path):
+    path = tmp_path / "report.pdf"
+    _make_pdf(path, REPORT_PAGES, compress=False)
+    with pymupdf.open(path) as src:
+        assert app._scan_raw_markers(str(path), src) == {0: (1, 3), 1: (2, 3), 3: (3, 3)}
+    assert _split(path) == EXPECTED_SPLIT
+
+
+def test_compressed_pdf_falls_back_to_text_scan(tmp_path):
+    path = tmp_path / "report.pdf"
+    _make_pdf(path, REPORT_PAGES, compress=True)
+    with pymupdf.open(path) as src:
+        assert app._scan_raw_markers(str(path), src) is None
+    assert _split(path) == EXPECTED_SPLIT
+
+
+def test_kerned_marker_triggers_full_rescan(tmp_path):
+    pages = [list(lines) for lines in REPORT_PAGES]
+    # The second marker is drawn as a kerned TJ array, so its raw bytes do not match.
+    pages[1][0] = b"[(Mess) -10 (age 2 of 3)] TJ T*"
+    path = tmp_path / "report.pdf"
+    _make_pdf(path, pages, compress=False)
+
+    with pymupdf.open(path) as src:
+        assert app._scan_raw_markers(str(path), src) is None
+        markers, skipped_pages = app._find_page_markers(src, None, use_raw_prefilter=True)
+        assert skipped_pages and not app._markers_complete(markers)
+        markers, skipped_pages = app._find_page_markers(src, None, use_raw_prefilter=False)
+        assert skipped_pages == 0 and app._markers_complete(markers)
+
+    # The kerned message must not be merged into the previous one.
+    assert _split(path) == EXPECTED_SPLIT
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_quoted_marker_in_body_does_not_split(tmp_path, compress):
+    pages = [list(lines) for lines in REPORT_PAGES]
+    # A continuation page quoting a marker below the header area.
+    pages[2] = BODY_LINES + ["As I said in Message 3 of 3, see above."]
+    path = tmp_path / "report.pdf"
+    _make_pdf(path, pages, compress=compress)
+    assert _split(path) == EXPECTED_SPLIT
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_header_drawn_after_body_is_found(tmp_path, compress):
+    pages = [list(lines) for lines in REPORT_PAGES]
+    # The marker comes last in the content stream, past the header search area.
+    pages[1] = BODY_LINES + ["Message 2 of 3"]
+    path = tmp_path / "report.pdf"
+    _make_pdf(path, pages, compress=compress)
+    with pymupdf.open(path) as src:
+        markers, _ = app._find_page_markers(src, None, use_raw_prefilter=False)
+        assert not app._markers_complete(markers)
+    # The message must not be merged into the previous one.
+    assert _split(path) == EXPECTED_SPLIT
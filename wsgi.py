@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI entry point for running the application under a production server.
+
+Example (see Procfile):
+    gunicorn -w 4 --timeout 300 wsgi:app
+"""
+
+from app import app